@@ -1,8 +1,13 @@
+import functools
+import os
 import pathlib
 import random
-from typing import Any, Dict, List, Optional
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Dict, List, Optional, Tuple
 
 import annoy
+import faiss
 import falcon
 import numpy as np
 from falcon.media.validators import jsonschema
@@ -12,7 +17,7 @@ from sentry_sdk.integrations.falcon import FalconIntegration
 
 import schema
 import settings
-from embeddings import EMBEDDING_STORE, add_logos
+from embeddings import EMBEDDING_STORE, add_logos, load_default_model
 from utils import get_image_from_url, get_logger, text_file_iter
 
 logger = get_logger()
@@ -24,16 +29,31 @@ class ANNIndex:
     """This class store an Annoy approximate nearest neighbors index and the
     keys associated with each item in the index. Each key corresponds to the
     logo annotation ID (primary key) in the LogoAnnotation table.
+
+    A FAISS index containing the same items can be provided, it is then used
+    for batch queries.
     
     :param index: An Annoy index
     :param keys: The ordered list of keys associated with the items in the
     index
+    :param faiss_index: An optional FAISS index, with the same items as the
+    Annoy index
     """
 
-    def __init__(self, index: annoy.AnnoyIndex, keys: List[int]):
+    def __init__(
+        self,
+        index: annoy.AnnoyIndex,
+        keys: List[int],
+        faiss_index: Optional[faiss.Index] = None,
+    ):
         self.index: annoy.AnnoyIndex = index
+        self.dimension: int = index.f
         self.keys: List[int] = keys
+        self.keys_arr: np.ndarray = np.asarray(keys, dtype=np.int64)
         self.key_to_ann_id = {x: i for i, x in enumerate(self.keys)}
+        self.faiss_index: Optional[faiss.Index] = faiss_index
+        # Search parameters are set on the FAISS index itself
+        self.faiss_lock = threading.Lock()
 
     @classmethod
     def load(cls, index_dir: pathlib.Path) -> "ANNIndex":
@@ -43,23 +63,75 @@ class ANNIndex:
         - the index named index.bin
         - the external keys (logo annotation IDs) in a file named index.txt
 
+        If the directory also contains a FAISS index named index.faiss (see
+        `manage.generate_index`), it is loaded as well.
+
         :param index_dir: The index directory to use
         """
         dimension = settings.INDEX_DIM[index_dir.name]
         index = annoy.AnnoyIndex(dimension, "euclidean")
-        index.load(str(index_dir / settings.INDEX_FILE_NAME), prefault=True)
+        index.load(
+            str(index_dir / settings.INDEX_FILE_NAME), prefault=settings.INDEX_PREFAULT
+        )
         keys = [int(x) for x in text_file_iter(index_dir / settings.KEYS_FILE_NAME)]
-        return cls(index, keys)
+        faiss_index = None
+        faiss_index_path = index_dir / settings.FAISS_INDEX_FILE_NAME
+
+        if settings.FAISS_ENABLED and faiss_index_path.is_file():
+            faiss_index = faiss.read_index(str(faiss_index_path))
+
+            if faiss_index.ntotal != len(keys) or faiss_index.d != dimension:
+                logger.warning(
+                    f"FAISS index {faiss_index_path} doesn't match the Annoy index, "
+                    "ignoring it"
+                )
+                faiss_index = None
+
+        return cls(index, keys, faiss_index)
+
+    def faiss_search(
+        self, embeddings: np.ndarray, count: int
+    ) -> Tuple[np.ndarray, np.ndarray]:
+        """Search the `count` nearest neighbors of each embedding in the
+        FAISS index, and return the squared L2 distances and the item
+        indexes, padded with -1.
+
+        :param embeddings: A float32 array of shape (num_queries, dimension)
+        :param count: The number of neighbors to return for each query
+        """
+        with self.faiss_lock:
+            if isinstance(self.faiss_index, faiss.IndexHNSW):
+                # HNSW explores only `efSearch` candidates: keep it well
+                # above `count` so that recall stays close to Annoy's
+                self.faiss_index.hnsw.efSearch = max(
+                    2 * count, settings.FAISS_EF_SEARCH
+                )
+
+            return self.faiss_index.search(embeddings, count)
+
 
+# Thread pool used to load indexes and to run batch Annoy queries: Annoy
+# releases the GIL during queries, so that they can run in parallel
+EXECUTOR = ThreadPoolExecutor(max_workers=os.cpu_count())
 
 logger.info("Loading ANN indexes...")
-INDEXES: Dict[str, ANNIndex] = {
-    index_dir.name: ANNIndex.load(index_dir)
+# Load indexes in parallel: FAISS index reads (and Annoy file reads, if
+# INDEX_PREFAULT is enabled) release the GIL, so that they run concurrently
+index_futures = {
+    index_dir.name: EXECUTOR.submit(ANNIndex.load, index_dir)
     for index_dir in settings.DATA_DIR.iterdir()
     if index_dir.is_dir()
 }
+INDEXES: Dict[str, ANNIndex] = {
+    index_name: future.result() for index_name, future in index_futures.items()
+}
 logger.info(f"Indexes loaded: {INDEXES.keys()}")
 
+# Load the embedding model at startup rather than on the first POST /ann/add
+logger.info("Loading embedding model...")
+load_default_model()
+logger.info("Embedding model loaded")
+
 
 class ANNResource:
     def on_get(
@@ -68,9 +140,15 @@ class ANNResource:
         """Search for nearest neighbors of:
         - a random logo (if logo_id not provided)
         - a specific logo otherwise
+
+        If `exact` is true and the logo is in the EmbeddingStore, an exact
+        search over the EmbeddingStore is performed instead of an ANN search.
+        If `distances` is false, results don't include distances.
         """
         index_name = req.get_param("index", default=settings.DEFAULT_INDEX)
         count = req.get_param_as_int("count", min_value=1, max_value=500, default=100)
+        exact = req.get_param_as_bool("exact", default=False)
+        with_distances = req.get_param_as_bool("distances", default=True)
 
         if index_name not in INDEXES:
             raise falcon.HTTPBadRequest("unknown index: {}".format(index_name))
@@ -80,7 +158,9 @@ class ANNResource:
         if logo_id is None:
             logo_id = ann_index.keys[random.randint(0, len(ann_index.keys) - 1)]
 
-        results = get_nearest_neighbors(ann_index, count, logo_id)
+        results = get_nearest_neighbors(
+            ann_index, count, logo_id, exact, with_distances
+        )
 
         if results is None:
             resp.status = falcon.HTTP_404
@@ -90,25 +170,44 @@ class ANNResource:
 
 class ANNBatchResource:
     def on_get(self, req: falcon.Request, resp: falcon.Response):
-        """Batch version (several logos) of ANNResource."""
+        """Batch version (several logos) of ANNResource.
+
+        When the FAISS index is enabled, nearest neighbors are searched in
+        the FAISS index instead of the Annoy index: as both are approximate,
+        results may differ from the ones of ANNResource for the same logo.
+        """
         index_name = req.get_param("index", default=settings.DEFAULT_INDEX)
         count = req.get_param_as_int("count", min_value=1, max_value=500, default=100)
         logo_ids = req.get_param_as_list(
             "logo_ids", required=True, transform=int, default=[]
         )
+        with_distances = req.get_param_as_bool("distances", default=True)
         logger.info(f"Received request for {index_name}, logos: {logo_ids}")
 
         if index_name not in INDEXES:
             raise falcon.HTTPBadRequest("unknown index: {}".format(index_name))
 
         ann_index = INDEXES[index_name]
-        results = {}
 
-        for logo_id in logo_ids:
-            logo_results = get_nearest_neighbors(ann_index, count, logo_id)
+        if ann_index.faiss_index is not None:
+            results = get_nearest_neighbors_batch(
+                ann_index, count, logo_ids, with_distances
+            )
+        else:
+            results = {}
+            all_logo_results = EXECUTOR.map(
+                functools.partial(
+                    get_nearest_neighbors,
+                    ann_index,
+                    count,
+                    with_distances=with_distances,
+                ),
+                logo_ids,
+            )
 
-            if logo_results is not None:
-                results[logo_id] = logo_results
+            for logo_id, logo_results in zip(logo_ids, all_logo_results):
+                if logo_results is not None:
+                    results[logo_id] = logo_results
 
         resp.media = {
             "results": results,
@@ -117,7 +216,11 @@ class ANNBatchResource:
 
 
 def get_nearest_neighbors(
-    ann_index: ANNIndex, count: int, logo_id: int
+    ann_index: ANNIndex,
+    count: int,
+    logo_id: int,
+    exact: bool = False,
+    with_distances: bool = True,
 ) -> Optional[List[Dict[str, Any]]]:
     """Return the nearest neighbors of a logo, using the ANN index.
     
@@ -130,16 +233,31 @@ def get_nearest_neighbors(
     This EmbeddingStore is updated with new logo embeddings each time POST /ann/add
     is called from robotoff.
 
+    If `exact` is True and the logo is in the EmbeddingStore, the nearest
+    neighbors are instead computed by brute force over all embeddings of the
+    EmbeddingStore.
+
     :param ann_index: The ANN index to use
     :param count: The number of results to return
     :param logo_id: The logo external ID (primary key in LogoAnnotation table)
     to use as query
+    :param exact: Whether to perform an exact search over the EmbeddingStore
+    :param with_distances: Whether to include distances in the results
     """
+    if exact:
+        embedding = EMBEDDING_STORE.get_embedding(logo_id)
+
+        if embedding is not None:
+            logo_ids, distances = EMBEDDING_STORE.get_exact_nearest_neighbors(
+                embedding, count
+            )
+            return build_results(logo_ids, distances if with_distances else None)
+
     if logo_id in ann_index.key_to_ann_id:
         logger.info(f"Trying to get nns for logo `{logo_id}`")
         item_index = ann_index.key_to_ann_id[logo_id]
-        indexes, distances = ann_index.index.get_nns_by_item(
-            item_index, count, include_distances=True
+        nns = ann_index.index.get_nns_by_item(
+            item_index, count, include_distances=with_distances
         )
         logger.info("Successfully retrieved distances and indexes")
     else:
@@ -149,18 +267,108 @@ def get_nearest_neighbors(
         if embedding is None:
             return None
 
-        indexes, distances = ann_index.index.get_nns_by_vector(
-            embedding, count, include_distances=True
+        nns = ann_index.index.get_nns_by_vector(
+            embedding, count, include_distances=with_distances
         )
         logger.info("Successfully retrieved distances and indexes")
 
-    logo_ids = [ann_index.keys[index] for index in indexes]
-    results = []
+    indexes, distances = nns if with_distances else (nns, None)
+    return build_results(ann_index.keys_arr.take(indexes).tolist(), distances)
+
 
-    for ann_logo_id, distance in zip(logo_ids, distances):
-        results.append({"distance": distance, "logo_id": ann_logo_id})
+def get_nearest_neighbors_batch(
+    ann_index: ANNIndex, count: int, logo_ids: List[int], with_distances: bool = True
+) -> Dict[int, List[Dict[str, Any]]]:
+    """Return the nearest neighbors of several logos, using the FAISS index
+    of the ANN index.
 
-    return results
+    Query embeddings are gathered from the EmbeddingStore in one go (if its
+    embeddings have the dimension of the index), logos missing from the
+    store are then looked up in the Annoy index. All embeddings are queried
+    with a single FAISS search. Logos without embedding are absent from the
+    returned dict, the other ones are in `logo_ids` order.
+
+    Note that FAISS and Annoy indexes are distinct approximate indexes: the
+    neighbors of a logo found here may differ from the ones returned by
+    `get_nearest_neighbors`, with a similar recall.
+
+    :param ann_index: The ANN index to use, it must have a FAISS index
+    :param count: The number of results to return for each logo
+    :param logo_ids: The logo external IDs to use as queries
+    :param with_distances: Whether to include distances in the results
+    """
+    if EMBEDDING_STORE.get_embedding_size() == ann_index.dimension:
+        query_logo_ids, embeddings = EMBEDDING_STORE.get_embeddings(logo_ids)
+    else:
+        # The EmbeddingStore holds embeddings of another model
+        query_logo_ids, embeddings = [], None
+
+    stored_logo_ids = set(query_logo_ids)
+    indexed_logo_ids = [
+        logo_id
+        for logo_id in logo_ids
+        if logo_id not in stored_logo_ids and logo_id in ann_index.key_to_ann_id
+    ]
+
+    if indexed_logo_ids:
+        indexed_embeddings = np.array(
+            [
+                ann_index.index.get_item_vector(ann_index.key_to_ann_id[logo_id])
+                for logo_id in indexed_logo_ids
+            ],
+            dtype=np.float32,
+        )
+        query_logo_ids += indexed_logo_ids
+        embeddings = (
+            indexed_embeddings
+            if embeddings is None
+            else np.concatenate((embeddings, indexed_embeddings))
+        )
+
+    if embeddings is None:
+        return {}
+
+    xq = np.ascontiguousarray(embeddings, dtype=np.float32)
+    distances, indexes = ann_index.faiss_search(xq, count)
+
+    if with_distances:
+        # FAISS returns squared L2 distances, while Annoy returns euclidean
+        # distances. Like Annoy, only take the square root of returned
+        # distances, in place.
+        np.sqrt(distances, out=distances)
+
+    results = {}
+
+    for logo_id, logo_indexes, logo_distances in zip(
+        query_logo_ids, indexes, distances
+    ):
+        # FAISS pads results with -1 when there are less than `count` items
+        mask = logo_indexes >= 0
+        results[logo_id] = build_results(
+            ann_index.keys_arr.take(logo_indexes[mask]).tolist(),
+            logo_distances[mask].tolist() if with_distances else None,
+        )
+
+    # Return results in the requested order
+    return {logo_id: results[logo_id] for logo_id in logo_ids if logo_id in results}
+
+
+def build_results(
+    logo_ids: List[int], distances: Optional[List[float]]
+) -> List[Dict[str, Any]]:
+    """Build the nearest neighbor results returned by the API.
+
+    :param logo_ids: The external IDs of the neighbors
+    :param distances: The distances of the neighbors to the query, in the
+    same order, or None to return results without distances
+    """
+    if distances is None:
+        return [{"logo_id": logo_id} for logo_id in logo_ids]
+
+    return [
+        {"distance": distance, "logo_id": logo_id}
+        for logo_id, distance in zip(logo_ids, distances)
+    ]
 
 
 class ANNEmbeddingResource:
@@ -180,6 +388,13 @@ class ANNEmbeddingResource:
 
         count = req.media.get("count", 1)
         embedding = req.media["embedding"]
+        with_distances = req.media.get("distances", True)
+
+        if not isinstance(with_distances, bool):
+            raise falcon.HTTPBadRequest(
+                "invalid distances",
+                "distances must be a boolean, here: {}".format(with_distances),
+            )
 
         if len(embedding) != settings.INDEX_DIM:
             raise falcon.HTTPBadRequest(
@@ -189,16 +404,11 @@ class ANNEmbeddingResource:
                 ),
             )
 
-        indexes, distances = ann_index.index.get_nns_by_vector(
-            embedding, count, include_distances=True
+        nns = ann_index.index.get_nns_by_vector(
+            embedding, count, include_distances=with_distances
         )
-
-        logo_ids = [ann_index.keys[index] for index in indexes]
-        results = []
-
-        for ann_logo_id, distance in zip(logo_ids, distances):
-            results.append({"distance": distance, "logo_id": ann_logo_id})
-
+        indexes, distances = nns if with_distances else (nns, None)
+        results = build_results(ann_index.keys_arr.take(indexes).tolist(), distances)
         resp.media = {"results": results, "count": len(results)}
 
 
@@ -214,7 +424,7 @@ class AddLogoResource:
         logos = req.media["logos"]
         logo_ids = [logo["id"] for logo in logos]
 
-        if all(logo_id in EMBEDDING_STORE for logo_id in logo_ids):
+        if EMBEDDING_STORE.get_logo_ids() >= set(logo_ids):
             resp.media = {
                 "added": 0,
             }
@@ -227,7 +437,7 @@ class AddLogoResource:
         if image is None:
             raise falcon.HTTPBadRequest("invalid image")
 
-        if np.array(image).shape[-1] != 3:
+        if image.mode != "RGB":
             image = image.convert("RGB")
 
         added = add_logos(image, logo_ids, bounding_boxes)
@@ -5,7 +5,11 @@ it from images.
 
 import operator
 import pathlib
-from typing import Any, Dict, Iterable, List, Optional, Tuple
+import queue
+import threading
+import time
+from concurrent.futures import Future
+from typing import Any, Dict, Iterable, KeysView, List, Optional, Tuple
 
 import h5py
 import numpy as np
@@ -14,24 +18,52 @@ from efficientnet_pytorch import EfficientNet
 from PIL import Image
 
 import settings
+from embeddings_bruteforce import topk_l2
+
+# Model input shape is fixed, let cuDNN benchmark and cache the fastest
+# convolution algorithms for it
+torch.backends.cudnn.benchmark = True
 
 
 class EmbeddingStore:
     """A class to store logo data and embeddings.
     
-    Embeddings are stored locally on disk in an HDF5 file.
+    Embeddings are stored locally on disk in an HDF5 file. By default, they
+    are also kept in memory, to avoid reading the HDF5 file on each query.
 
     :param hdf5_path: Path of the HDF5 file where the logo embeddings are
     stored. If the file does not exist, the file will be created the first
     time `save_embeddings` is called
+    :param in_memory: If False, embeddings are not loaded in memory and are
+    read from the HDF5 file when needed. `get_embeddings` and
+    `get_exact_nearest_neighbors` are not available in this mode.
     """
 
-    def __init__(self, hdf5_path: pathlib.Path):
+    def __init__(self, hdf5_path: pathlib.Path, in_memory: bool = True):
         self.hdf5_path = hdf5_path
+        self.in_memory = in_memory
+        # Requests adding logos may run concurrently
+        self.lock = threading.Lock()
         self.logo_id_to_idx: Dict[int, int] = self.load_logo_id_to_index(hdf5_path)
         self.offset = (
             max(self.logo_id_to_idx.values()) + 1 if self.logo_id_to_idx else 0
         )
+        # In-memory copy of the embeddings and external IDs, only the first
+        # `offset` rows are valid, the remaining ones are preallocated for
+        # future additions. Stale rows, left behind when a logo is saved
+        # again, have a 0 external ID.
+        self._embeddings: Optional[np.ndarray] = None
+        self._external_ids: Optional[np.ndarray] = None
+
+        if in_memory:
+            self._embeddings, self._external_ids = self.load_embeddings(
+                hdf5_path, self.offset
+            )
+
+            if self._external_ids is not None:
+                is_current = np.zeros(self.offset, dtype=bool)
+                is_current[list(self.logo_id_to_idx.values())] = True
+                self._external_ids[~is_current] = 0
 
     def __len__(self):
         return len(self.logo_id_to_idx)
@@ -39,10 +71,22 @@ class EmbeddingStore:
     def __contains__(self, logo_id: int) -> bool:
         return self.get_index(logo_id) is not None
 
-    def get_logo_ids(self) -> Iterable[int]:
-        """Return an iterable of the external IDs of stored logos."""
+    def get_logo_ids(self) -> KeysView[int]:
+        """Return a set-like view of the external IDs of stored logos."""
         return self.logo_id_to_idx.keys()
 
+    def get_embedding_size(self) -> Optional[int]:
+        """Return the size of stored embeddings, or None if the HDF5 file
+        does not exist yet."""
+        if self._embeddings is not None:
+            return self._embeddings.shape[-1]
+
+        if self.hdf5_path.is_file():
+            with h5py.File(self.hdf5_path, "r") as f:
+                return f["embedding"].shape[-1]
+
+        return None
+
     def get_index(self, logo_id: int) -> Optional[int]:
         """Return the index associated with a logo in the ANN index.
         
@@ -60,13 +104,81 @@ class EmbeddingStore:
         if idx is None:
             return None
 
-        if self.hdf5_path.is_file():
+        if self._embeddings is not None:
+            return self._embeddings[idx]
+
+        if not self.in_memory and self.hdf5_path.is_file():
             with h5py.File(self.hdf5_path, "r") as f:
                 embedding_dset = f["embedding"]
                 return embedding_dset[idx]
 
         return None
 
+    def get_embeddings(
+        self, logo_ids: List[int]
+    ) -> Tuple[List[int], Optional[np.ndarray]]:
+        """Return the embeddings of several logos, as an array of shape
+        (num_logos, embedding_size).
+
+        Logos that are not in the store are skipped: the external IDs of the
+        logos that were found are returned along with the array, in the same
+        order. The array is None if no logo was found.
+
+        :param logo_ids: The external IDs of the logos
+        """
+        self._check_in_memory()
+        found_logo_ids = [
+            logo_id for logo_id in logo_ids if logo_id in self.logo_id_to_idx
+        ]
+
+        if not found_logo_ids or self._embeddings is None:
+            return [], None
+
+        idxs = np.fromiter(
+            (self.logo_id_to_idx[logo_id] for logo_id in found_logo_ids),
+            dtype=np.int64,
+            count=len(found_logo_ids),
+        )
+        return found_logo_ids, np.take(self._embeddings, idxs, axis=0)
+
+    def get_exact_nearest_neighbors(
+        self, embedding: np.ndarray, count: int
+    ) -> Tuple[List[int], List[float]]:
+        """Return the external IDs and the euclidean distances of the `count`
+        stored logos closest to an embedding, sorted by increasing distance.
+
+        Unlike ANN indexes, all stored embeddings are compared to the query
+        embedding (brute force search), including the ones of logos added
+        since the last index generation. Stale embeddings of logos that were
+        saved again are skipped.
+
+        :param embedding: The query embedding
+        :param count: The number of results to return
+        """
+        self._check_in_memory()
+
+        if self._embeddings is None:
+            return [], []
+
+        # Fetch enough neighbors to fill `count` results once stale rows are
+        # removed
+        stale_count = self.offset - len(self.logo_id_to_idx)
+        indexes, distances = topk_l2(
+            self._embeddings[: self.offset],
+            np.ascontiguousarray(embedding, dtype=np.float32),
+            count + stale_count,
+        )
+        external_ids = self._external_ids.take(indexes)
+        is_current = external_ids != 0
+        return (
+            external_ids[is_current][:count].tolist(),
+            distances[is_current][:count].tolist(),
+        )
+
+    def _check_in_memory(self):
+        if not self.in_memory:
+            raise ValueError("this operation requires an in-memory EmbeddingStore")
+
     @staticmethod
     def load_logo_id_to_index(hdf5_path: pathlib.Path) -> Dict[int, int]:
         """Read the HDF5 file and generate the logo ID to index mapping."""
@@ -76,12 +188,36 @@ class EmbeddingStore:
                 array = external_id_dset[:]
                 non_zero_indexes = np.flatnonzero(array)
                 array = array[: non_zero_indexes[-1] + 1]
-                return {int(x): i for i, x in enumerate(array)}
+                # tolist converts all IDs to Python ints in a single C loop
+                return dict(zip(array.tolist(), range(len(array))))
 
         return {}
 
-    def iter_embeddings(self) -> Iterable[Tuple[int, np.ndarray]]:
-        """Iterate over HDF5 file and yield (logo_id, embedding) tuples."""
+    @staticmethod
+    def load_embeddings(
+        hdf5_path: pathlib.Path, count: int
+    ) -> Tuple[Optional[np.ndarray], Optional[np.ndarray]]:
+        """Read the first `count` embeddings (as a float32 array) and external
+        IDs (as an int64 array) of the HDF5 file, or return (None, None) if
+        the file does not exist."""
+        if hdf5_path.is_file():
+            with h5py.File(hdf5_path, "r") as f:
+                return (
+                    f["embedding"][:count].astype(np.float32, copy=False),
+                    f["external_id"][:count].astype(np.int64),
+                )
+
+        return None, None
+
+    def iter_embeddings(
+        self, batch_size: int = 1024
+    ) -> Iterable[Tuple[int, np.ndarray]]:
+        """Iterate over stored embeddings and yield (logo_id, embedding)
+        tuples.
+
+        If the store is not in memory, embeddings are read from the HDF5 file
+        by ranges of contiguous indexes, of at most `batch_size` rows.
+        """
         if not self.hdf5_path.is_file():
             return
 
@@ -90,11 +226,33 @@ class EmbeddingStore:
             key=operator.itemgetter(0),
         )
 
+        if self._embeddings is not None:
+            for idx, logo_id in idx_logo_id:
+                yield logo_id, self._embeddings[idx]
+            return
+
         with h5py.File(self.hdf5_path, "r") as f:
             embedding_dset = f["embedding"]
-            for idx, logo_id in idx_logo_id:
-                embedding = embedding_dset[idx]
-                yield logo_id, embedding
+            start = 0
+
+            while start < len(idx_logo_id):
+                first_idx = idx_logo_id[start][0]
+                end = start + 1
+
+                while (
+                    end < len(idx_logo_id)
+                    and end - start < batch_size
+                    and idx_logo_id[end][0] == first_idx + end - start
+                ):
+                    end += 1
+
+                end_idx = first_idx + end - start
+                embeddings = embedding_dset[first_idx:end_idx]
+
+                for (_, logo_id), embedding in zip(idx_logo_id[start:end], embeddings):
+                    yield logo_id, embedding
+
+                start = end
 
     def save_embeddings(
         self,
@@ -108,6 +266,10 @@ class EmbeddingStore:
         :param external_ids: a numpy array of external IDs (integer) of shape
         (num_logos, ).
         """
+        with self.lock:
+            self._save_embeddings(embeddings, external_ids)
+
+    def _save_embeddings(self, embeddings: np.ndarray, external_ids: np.ndarray):
         file_exists = self.hdf5_path.is_file()
 
         with h5py.File(self.hdf5_path, "a") as f:
@@ -132,27 +294,109 @@ class EmbeddingStore:
             embedding_dset[slicing] = embeddings
             external_id_dset[slicing] = external_ids
 
-            for external_id, idx in zip(
-                external_ids, range(self.offset, self.offset + len(embeddings))
-            ):
-                self.logo_id_to_idx[int(external_id)] = idx
+            external_id_list = external_ids.tolist()
+            # Indexes of the previous embeddings of logos saved again
+            stale_idxs = [
+                self.logo_id_to_idx[external_id]
+                for external_id in external_id_list
+                if external_id in self.logo_id_to_idx
+            ]
+            self.logo_id_to_idx.update(
+                zip(external_id_list, range(slicing.start, slicing.stop))
+            )
+
+            if self.in_memory:
+                self._reserve(slicing.stop, embeddings.shape[-1])
+                self._embeddings[slicing] = embeddings
+                self._external_ids[slicing] = external_ids
+                # Logos may also appear several times in `external_ids`
+                stale_idxs += [
+                    idx
+                    for idx, external_id in enumerate(external_id_list, slicing.start)
+                    if self.logo_id_to_idx[external_id] != idx
+                ]
+                self._external_ids[stale_idxs] = 0
 
             self.offset += len(embeddings)
 
+    def _reserve(self, count: int, embedding_size: int):
+        """Make sure the in-memory embedding and external ID arrays can hold
+        `count` rows.
+
+        Arrays grow geometrically, so that adding logos one request at a time
+        doesn't copy the whole arrays each time.
+        """
+        capacity = 0 if self._embeddings is None else len(self._embeddings)
+
+        if count <= capacity:
+            return
+
+        capacity = max(count, capacity + capacity // 4, 1024)
+        embeddings = np.empty((capacity, embedding_size), dtype=np.float32)
+        external_ids = np.zeros(capacity, dtype=np.int64)
+
+        if self._embeddings is not None:
+            embeddings[: self.offset] = self._embeddings[: self.offset]
+            external_ids[: self.offset] = self._external_ids[: self.offset]
+
+        self._embeddings = embeddings
+        self._external_ids = external_ids
+
 
 EMBEDDING_STORE = EmbeddingStore(settings.EMBEDDINGS_HDF5_PATH)
 
 
-def generate_embeddings(model, images: np.ndarray, device: torch.device) -> np.ndarray:
-    images = np.moveaxis(images, -1, 1)  # move channel dim to 1st dim
+def get_default_device() -> torch.device:
+    """Return the CUDA device if available, the CPU otherwise."""
+    return torch.device("cuda" if torch.cuda.is_available() else "cpu")
+
+
+def generate_embeddings(
+    model, images: torch.Tensor, device: torch.device
+) -> np.ndarray:
+    """Compute the embeddings of a batch of images.
+
+    :param model: The EfficientNet model
+    :param images: A tensor of shape (num_images, 3, image_dim, image_dim)
+    :param device: The torch device the model is on
+    """
+    dtype = next(model.parameters()).dtype
+    memory_format = (
+        torch.channels_last if device.type == "cuda" else torch.contiguous_format
+    )
 
     with torch.no_grad():
-        torch_images = torch.tensor(images, dtype=torch.float32, device=device)
-        embeddings = model.extract_features(torch_images).cpu().numpy()
+        images = images.to(device, dtype=dtype, memory_format=memory_format)
+        embeddings = model.extract_features(images).float().cpu().numpy()
 
     return np.max(embeddings, (-1, -2))
 
 
+def resize_images(
+    images: List[Image.Image], image_dim: int, device: torch.device
+) -> torch.Tensor:
+    """Resize RGB images to (image_dim, image_dim) and send them to the torch
+    device.
+
+    Images are resized with PIL (its bicubic filter antialiases when
+    downscaling, as when the stored embeddings were generated) into a single
+    uint8 buffer, which is sent to the device in one copy.
+
+    :param images: The images to resize
+    :param image_dim: The output height and width
+    :param device: The torch device to send the images to
+    :return: a uint8 tensor of shape (num_images, 3, image_dim, image_dim)
+    """
+    buffer = np.empty((len(images), image_dim, image_dim, 3), dtype=np.uint8)
+
+    for i, image in enumerate(images):
+        buffer[i] = np.asarray(image.resize((image_dim, image_dim)), dtype=np.uint8)
+
+    # move channel dim to 1st dim: this is a view, whose memory layout is
+    # channels_last
+    return torch.from_numpy(buffer).to(device).permute(0, 3, 1, 2)
+
+
 def crop_image(
     image: Image.Image, bounding_box: Tuple[float, float, float, float]
 ) -> Image.Image:
@@ -186,9 +430,8 @@ def add_logos(
     :param device: The torch device to use to compute the embeddings
     """
     if device is None:
-        device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
+        device = get_default_device()
 
-    model = ModelStore.get(settings.DEFAULT_MODEL, device)
     image_dim = settings.IMAGE_INPUT_DIM[settings.DEFAULT_MODEL]
 
     selected_external_ids = []
@@ -204,13 +447,19 @@ def add_logos(
     if not selected_bounding_boxes:
         return 0
 
-    images = np.zeros((len(selected_bounding_boxes), image_dim, image_dim, 3))
-    for i, bounding_box in enumerate(selected_bounding_boxes):
-        cropped_image = crop_image(image, bounding_box)
-        cropped_image = cropped_image.resize((image_dim, image_dim))
-        images[i] = np.array(cropped_image)
+    cropped_images = [
+        crop_image(image, bounding_box) for bounding_box in selected_bounding_boxes
+    ]
+    images = resize_images(cropped_images, image_dim, device)
+
+    if settings.SERVER_THREADS > 1:
+        batcher = EmbeddingBatcher.get(settings.DEFAULT_MODEL, device)
+        embeddings = batcher.submit(images).result()
+    else:
+        # No concurrent request can share the forward pass
+        model = ModelStore.get(settings.DEFAULT_MODEL, device)
+        embeddings = generate_embeddings(model, images, device)
 
-    embeddings = generate_embeddings(model, images, device)
     EMBEDDING_STORE.save_embeddings(
         embeddings, np.array(selected_external_ids, dtype="i")
     )
@@ -218,14 +467,149 @@ def add_logos(
 
 
 class ModelStore:
-    """Simple class to store in memory the embedding models."""
+    """Simple class to store in memory the embedding models.
+
+    Models are traced with TorchScript, only their `extract_features` method
+    is available.
+    """
     store: Dict[str, Any] = {}
 
     @classmethod
     def get(cls, model_name: str, device: torch.device):
         if model_name not in cls.store:
             model = EfficientNet.from_pretrained(model_name)
+            # The memory-efficient Swish implementation can't be traced
+            model.set_swish(memory_efficient=False)
             model = model.to(device)
+            memory_format = torch.contiguous_format
+
+            if device.type == "cuda":
+                # Half precision and channels_last memory layout speed up
+                # convolutions on GPU
+                model = model.half().to(memory_format=torch.channels_last)
+                memory_format = torch.channels_last
+
+            if settings.MODEL_EVAL_MODE:
+                # Use running statistics for batch normalization and disable
+                # drop connect, so that embeddings don't depend on the batch
+                model = model.eval()
+
+            image_dim = settings.IMAGE_INPUT_DIM[model_name]
+            example_images = torch.zeros(
+                (1, 3, image_dim, image_dim),
+                dtype=next(model.parameters()).dtype,
+                device=device,
+            ).contiguous(memory_format=memory_format)
+
+            with torch.no_grad():
+                model = torch.jit.trace_module(
+                    model, {"extract_features": example_images}
+                )
+
             cls.store[model_name] = model
 
         return cls.store[model_name]
+
+
+class EmbeddingBatcher:
+    """Coalesce the embedding computations of concurrent requests.
+
+    Image batches are submitted to a queue, which is drained by a background
+    thread: batches submitted less than `settings.EMBEDDING_BATCH_WINDOW`
+    seconds after the first one (up to `settings.EMBEDDING_MAX_BATCH_SIZE`
+    images) are concatenated and run through the model in a single forward
+    pass. On GPU, the forward pass is run on a dedicated CUDA stream.
+
+    This is only useful if requests are served by several threads (see
+    `settings.SERVER_THREADS`).
+
+    :param model_name: The name of the embedding model to use
+    :param device: The torch device to use to compute the embeddings
+    """
+
+    store: Dict[Tuple[str, torch.device], "EmbeddingBatcher"] = {}
+    store_lock = threading.Lock()
+
+    def __init__(self, model_name: str, device: torch.device):
+        self.model_name = model_name
+        self.device = device
+        self.queue: "queue.Queue[Tuple[torch.Tensor, Future]]" = queue.Queue()
+        self.stream = torch.cuda.Stream(device) if device.type == "cuda" else None
+        self.thread = threading.Thread(
+            target=self.run, name="embedding-batcher", daemon=True
+        )
+        self.thread.start()
+
+    @classmethod
+    def get(cls, model_name: str, device: torch.device) -> "EmbeddingBatcher":
+        key = (model_name, device)
+
+        with cls.store_lock:
+            if key not in cls.store:
+                cls.store[key] = cls(model_name, device)
+
+            return cls.store[key]
+
+    def submit(self, images: torch.Tensor) -> Future:
+        """Submit a batch of images, and return a future of their embeddings.
+
+        :param images: A tensor of shape (num_images, 3, image_dim, image_dim)
+        """
+        future: Future = Future()
+        self.queue.put((images, future))
+        return future
+
+    def run(self):
+        model = None
+
+        while True:
+            requests = [self.queue.get()]
+            image_count = len(requests[0][0])
+            deadline = time.monotonic() + settings.EMBEDDING_BATCH_WINDOW
+
+            while image_count < settings.EMBEDDING_MAX_BATCH_SIZE:
+                try:
+                    request = self.queue.get(
+                        timeout=max(deadline - time.monotonic(), 0)
+                    )
+                except queue.Empty:
+                    break
+
+                requests.append(request)
+                image_count += len(request[0])
+
+            try:
+                if model is None:
+                    model = ModelStore.get(self.model_name, self.device)
+
+                embeddings = self.generate_embeddings(
+                    model, [images for images, _ in requests]
+                )
+            except Exception as e:
+                for _, future in requests:
+                    future.set_exception(e)
+                continue
+
+            offset = 0
+            for images, future in requests:
+                next_offset = offset + len(images)
+                future.set_result(embeddings[offset:next_offset])
+                offset = next_offset
+
+    def generate_embeddings(self, model, images: List[torch.Tensor]) -> np.ndarray:
+        if self.stream is None:
+            return generate_embeddings(model, torch.cat(images), self.device)
+
+        # Images were resized on the default stream by the request threads
+        self.stream.wait_stream(torch.cuda.default_stream(self.device))
+
+        with torch.cuda.stream(self.stream):
+            embeddings = generate_embeddings(model, torch.cat(images), self.device)
+
+        self.stream.synchronize()
+        return embeddings
+
+
+def load_default_model():
+    """Load the default embedding model on the default device."""
+    return ModelStore.get(settings.DEFAULT_MODEL, get_default_device())
@@ -0,0 +1,48 @@
+"""
+This module provides an exact (brute force) nearest neighbors search over an
+embedding matrix, compiled with Numba.
+"""
+
+from typing import Tuple
+
+import numba
+import numpy as np
+
+
+@numba.njit("f4[::1](f4[:, ::1], f4[::1])", fastmath=True, parallel=True, cache=True)
+def squared_euclidean_distances(embeddings: np.ndarray, query: np.ndarray):
+    """Return the squared euclidean distance between `query` and each row of
+    `embeddings`."""
+    n, d = embeddings.shape
+    distances = np.empty(n, dtype=np.float32)
+
+    for i in numba.prange(n):
+        s = np.float32(0)
+        for j in range(d):
+            diff = embeddings[i, j] - query[j]
+            s += diff * diff
+        distances[i] = s
+
+    return distances
+
+
+def topk_l2(
+    embeddings: np.ndarray, query: np.ndarray, k: int
+) -> Tuple[np.ndarray, np.ndarray]:
+    """Return the indexes and the euclidean distances of the `k` rows of
+    `embeddings` closest to `query`, sorted by increasing distance.
+
+    :param embeddings: A C-contiguous float32 array of shape
+    (num_embeddings, embedding_size)
+    :param query: A float32 array of shape (embedding_size, )
+    :param k: The number of neighbors to return
+    """
+    distances = squared_euclidean_distances(embeddings, query)
+    k = min(k, len(distances))
+
+    if k == 0:
+        return np.empty(0, dtype=np.int64), np.empty(0, dtype=np.float32)
+
+    indexes = np.argpartition(distances, k - 1)[:k]
+    indexes = indexes[np.argsort(distances[indexes])]
+    return indexes, np.sqrt(distances[indexes])
@@ -1,3 +1,8 @@
+import os
+
 bind = ":5501"
 workers = 1
+# Several threads allow concurrent /ann/add requests to share model forward
+# passes (see embeddings.EmbeddingBatcher and settings.SERVER_THREADS)
+threads = int(os.environ.get("GUNICORN_THREADS", "1"))
 timeout = 60
@@ -10,16 +10,23 @@ if __name__ == "__main__":
     @click.command()
     @click.argument("output", type=pathlib.Path)
     @click.option("--tree-count", type=int, default=100)
-    def generate_index(output: pathlib.Path, tree_count: int):
+    @click.option("--faiss/--no-faiss", "with_faiss", default=True)
+    def generate_index(output: pathlib.Path, tree_count: int, with_faiss: bool):
         """Create a new version of the index using all embeddings stored in
         the EmbeddingStore.
+
+        Unless `--no-faiss` is passed, a FAISS index with the same items is
+        also generated, next to the Annoy index (see `api.ANNIndex.load`).
         
         :param output: Path of the output index
         :param tree_count: Number of trees to use when building the Annoy index
+        :param with_faiss: Whether to also generate the FAISS index
         """
         import shutil
         import tempfile
 
+        import faiss
+        import numpy as np
         import tqdm
         from annoy import AnnoyIndex
 
@@ -37,9 +44,12 @@ if __name__ == "__main__":
             shutil.copy(str(settings.EMBEDDINGS_HDF5_PATH), str(embedding_path))
 
             logger.info(f"Loading {embedding_path}...")
-            embedding_store = EmbeddingStore(embedding_path)
+            embedding_store = EmbeddingStore(embedding_path, in_memory=False)
 
             index = None
+            faiss_index = None
+            # FAISS vectors are added by batches
+            faiss_batch = []
             offset: int = 0
             keys = []
 
@@ -49,10 +59,24 @@ if __name__ == "__main__":
                     output_dim = embedding.shape[-1]
                     index = AnnoyIndex(output_dim, "euclidean")
 
+                    if with_faiss:
+                        faiss_index = (
+                            faiss.IndexHNSWFlat(output_dim, settings.FAISS_HNSW_M)
+                            if settings.FAISS_HNSW_M
+                            else faiss.IndexFlatL2(output_dim)
+                        )
+
                 index.add_item(offset, embedding)
                 keys.append(int(logo_id))
                 offset += 1
 
+                if faiss_index is not None:
+                    faiss_batch.append(embedding)
+
+                    if len(faiss_batch) == 10000:
+                        faiss_index.add(np.array(faiss_batch, dtype=np.float32))
+                        faiss_batch = []
+
             logger.info("Building index...")
             if index is not None:
                 index.build(tree_count)
@@ -67,5 +91,13 @@ if __name__ == "__main__":
 
                 logger.info("Keys saved.")
 
+                if faiss_index is not None:
+                    if faiss_batch:
+                        faiss_index.add(np.array(faiss_batch, dtype=np.float32))
+
+                    logger.info("Saving FAISS index...")
+                    faiss.write_index(faiss_index, str(output.with_suffix(".faiss")))
+                    logger.info("FAISS index saved.")
+
     cli.add_command(generate_index)
     cli()
@@ -12,12 +12,40 @@ INDEX_DIM: Dict[str, int] = {"efficientnet-b0": 1280, "efficientnet-b5": 2048}
 IMAGE_INPUT_DIM: Dict[str, int] = {"efficientnet-b0": 224}
 
 INDEX_FILE_NAME = "index.bin"
+# Read the whole Annoy index files in memory when loading them, instead of
+# reading pages on demand
+INDEX_PREFAULT = os.environ.get("INDEX_PREFAULT", "0") == "1"
 KEYS_FILE_NAME = "index.txt"
 
 DEFAULT_INDEX = "efficientnet-b0"
 DEFAULT_MODEL = "efficientnet-b0"
 DEFAULT_HDF5_COUNT = 10000000
 EMBEDDINGS_HDF5_PATH = DATA_DIR / "efficientnet-b0.hdf5"
+# Run the embedding model in evaluation mode. The existing store and indexes
+# hold training mode embeddings, which are not comparable with evaluation mode
+# ones: keep it off until stored embeddings are recomputed (see README.md)
+MODEL_EVAL_MODE = os.environ.get("MODEL_EVAL_MODE", "0") == "1"
+# Number of threads serving requests (see gunicorn_conf.py)
+SERVER_THREADS = int(os.environ.get("GUNICORN_THREADS", "1"))
+# When several threads serve requests, embedding computations of requests
+# received within this window (in seconds) are batched together, up to
+# EMBEDDING_MAX_BATCH_SIZE images
+EMBEDDING_BATCH_WINDOW = float(os.environ.get("EMBEDDING_BATCH_WINDOW", "0.01"))
+EMBEDDING_MAX_BATCH_SIZE = int(os.environ.get("EMBEDDING_MAX_BATCH_SIZE", "64"))
+
+# Load the FAISS index generated alongside each Annoy index (see
+# manage.generate_index), used for batch queries. It keeps a copy of all index
+# vectors in memory.
+FAISS_ENABLED = os.environ.get("FAISS_ENABLED", "1") == "1"
+FAISS_INDEX_FILE_NAME = "index.faiss"
+# Number of neighbors per node of the FAISS HNSW graph, when generating
+# indexes. If 0, an exact (flat) index is generated instead: its search cost
+# grows linearly with the number of indexed logos, so it is only suitable for
+# small indexes
+FAISS_HNSW_M = int(os.environ.get("FAISS_HNSW_M", "32"))
+# Minimum number of candidates explored by FAISS HNSW searches (efSearch), at
+# least twice the number of requested neighbors are explored
+FAISS_EF_SEARCH = int(os.environ.get("FAISS_EF_SEARCH", "128"))
 
 _ann_instance = os.environ.get("ANN_INSTANCE", "dev")
 _sentry_dsn = os.environ.get("SENTRY_DSN")
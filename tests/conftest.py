@@ -0,0 +1,4 @@
+import os
+
+# Sentry is initialized when the API module is imported
+os.environ.setdefault("SENTRY_DSN", "disabled")
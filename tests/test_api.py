@@ -0,0 +1,218 @@
+import importlib
+import sys
+
+import annoy
+import faiss
+import numpy as np
+import pytest
+from falcon import testing
+
+import embeddings
+import settings
+from embeddings import EmbeddingStore
+
+EMBEDDING_SIZE = 8
+
+
+@pytest.fixture(scope="module")
+def api(tmp_path_factory):
+    # Indexes and the embedding model are loaded when the module is imported
+    with pytest.MonkeyPatch.context() as monkeypatch:
+        monkeypatch.setattr(settings, "DATA_DIR", tmp_path_factory.mktemp("data"))
+        monkeypatch.setattr(embeddings, "load_default_model", lambda: None)
+        sys.modules.pop("api", None)
+        yield importlib.import_module("api")
+
+    sys.modules.pop("api", None)
+
+
+@pytest.fixture
+def ann_index(api, tmp_path, monkeypatch):
+    """An ANN index of 5 logos (IDs 1 to 5), the first 3 of which are in the
+    EmbeddingStore. Logo 10 is only in the EmbeddingStore."""
+    rng = np.random.default_rng(0)
+    vectors = rng.random((5, EMBEDDING_SIZE), dtype=np.float32)
+    keys = [1, 2, 3, 4, 5]
+
+    index = annoy.AnnoyIndex(EMBEDDING_SIZE, "euclidean")
+    for i, vector in enumerate(vectors):
+        index.add_item(i, vector)
+    index.build(10)
+
+    faiss_index = faiss.IndexFlatL2(EMBEDDING_SIZE)
+    faiss_index.add(vectors)
+
+    store = EmbeddingStore(tmp_path / "embeddings.hdf5")
+    store.save_embeddings(
+        np.concatenate((vectors[:3], rng.random((1, EMBEDDING_SIZE), dtype="f"))),
+        np.array([1, 2, 3, 10]),
+    )
+    monkeypatch.setattr(api, "EMBEDDING_STORE", store)
+    return api.ANNIndex(index, keys, faiss_index)
+
+
+@pytest.fixture
+def client(api, ann_index, monkeypatch):
+    monkeypatch.setattr(api, "INDEXES", {"test": ann_index})
+    return testing.TestClient(api.api)
+
+
+def test_ann_exact(client):
+    # Logo 10 is not in the Annoy index: without `exact`, its embedding is
+    # used to query the Annoy index
+    response = client.simulate_get("/api/v1/ann/10", params={"index": "test"})
+    assert 10 not in [r["logo_id"] for r in response.json["results"]]
+
+    response = client.simulate_get(
+        "/api/v1/ann/10", params={"index": "test", "count": 3, "exact": "true"}
+    )
+    results = response.json["results"]
+    assert response.json["count"] == 3
+    assert results[0]["logo_id"] == 10
+    assert results[0]["distance"] == pytest.approx(0, abs=1e-3)
+    assert {r["logo_id"] for r in results} <= {1, 2, 3, 10}
+
+
+def test_get_nearest_neighbors_batch(api, ann_index):
+    results = api.get_nearest_neighbors_batch(ann_index, 3, [4, 42, 10, 1])
+
+    # Logo 42 has no embedding, logo 4 is only in the Annoy index
+    assert list(results.keys()) == [4, 10, 1]
+
+    for logo_id in (4, 1):
+        assert len(results[logo_id]) == 3
+        assert results[logo_id][0]["logo_id"] == logo_id
+        assert results[logo_id][0]["distance"] == pytest.approx(0, abs=1e-3)
+
+        expected = api.get_nearest_neighbors(ann_index, 3, logo_id)
+        assert [r["logo_id"] for r in results[logo_id]] == [
+            r["logo_id"] for r in expected
+        ]
+        assert [r["distance"] for r in results[logo_id]] == pytest.approx(
+            [r["distance"] for r in expected], rel=1e-4, abs=1e-4
+        )
+
+    assert len(results[10]) == 3
+
+
+def test_get_nearest_neighbors_batch_padding(api, ann_index):
+    # FAISS pads results with -1 when more neighbors than indexed items are
+    # requested
+    results = api.get_nearest_neighbors_batch(ann_index, 10, [2], with_distances=False)
+
+    assert sorted(r["logo_id"] for r in results[2]) == [1, 2, 3, 4, 5]
+    assert all("distance" not in r for r in results[2])
+
+
+def test_get_nearest_neighbors_batch_no_embeddings(api, ann_index):
+    assert api.get_nearest_neighbors_batch(ann_index, 3, [42, 43]) == {}
+
+
+def build_annoy_index(vectors: np.ndarray) -> annoy.AnnoyIndex:
+    index = annoy.AnnoyIndex(vectors.shape[-1], "euclidean")
+    for i, vector in enumerate(vectors):
+        index.add_item(i, vector)
+    index.build(10)
+    return index
+
+
+def test_get_nearest_neighbors_batch_other_dimension(api, ann_index):
+    # The EmbeddingStore holds embeddings of size 8: query vectors are taken
+    # from the index items instead
+    rng = np.random.default_rng(1)
+    vectors = rng.random((4, 12), dtype=np.float32)
+    faiss_index = faiss.IndexFlatL2(12)
+    faiss_index.add(vectors)
+    other_index = api.ANNIndex(build_annoy_index(vectors), [1, 2, 3, 4], faiss_index)
+
+    results = api.get_nearest_neighbors_batch(other_index, 2, [1, 10, 3])
+
+    assert list(results.keys()) == [1, 3]
+    assert [r["logo_id"] for r in results[3]][0] == 3
+
+
+def test_get_nearest_neighbors_batch_hnsw_recall(api, monkeypatch, tmp_path):
+    monkeypatch.setattr(api, "EMBEDDING_STORE", EmbeddingStore(tmp_path / "e.hdf5"))
+    rng = np.random.default_rng(2)
+    vectors = rng.random((2000, 16), dtype=np.float32)
+    keys = list(range(1, len(vectors) + 1))
+    hnsw_index = faiss.IndexHNSWFlat(16, 8)
+    hnsw_index.add(vectors)
+    flat_index = faiss.IndexFlatL2(16)
+    flat_index.add(vectors)
+    ann_index = api.ANNIndex(build_annoy_index(vectors), keys, hnsw_index)
+    logo_ids = keys[:50]
+
+    for count in (10, 100):
+        results = api.get_nearest_neighbors_batch(ann_index, count, logo_ids)
+        _, expected_indexes = flat_index.search(vectors[:50], count)
+        recall = np.mean(
+            [
+                len({r["logo_id"] for r in results[logo_id]} & set(indexes)) / count
+                for logo_id, indexes in zip(logo_ids, (expected_indexes + 1).tolist())
+            ]
+        )
+        assert recall >= 0.9
+
+
+def test_ann_index_load(api, monkeypatch, tmp_path):
+    monkeypatch.setattr(settings, "INDEX_DIM", {"test": EMBEDDING_SIZE})
+    index_dir = tmp_path / "test"
+    index_dir.mkdir()
+    vectors = np.random.default_rng(3).random((3, EMBEDDING_SIZE), dtype=np.float32)
+    build_annoy_index(vectors).save(str(index_dir / settings.INDEX_FILE_NAME))
+    (index_dir / settings.KEYS_FILE_NAME).write_text("4\n5\n6\n")
+
+    assert api.ANNIndex.load(index_dir).faiss_index is None
+
+    faiss_index = faiss.IndexFlatL2(EMBEDDING_SIZE)
+    faiss_index.add(vectors)
+    faiss.write_index(faiss_index, str(index_dir / settings.FAISS_INDEX_FILE_NAME))
+    ann_index = api.ANNIndex.load(index_dir)
+
+    assert ann_index.keys == [4, 5, 6]
+    assert ann_index.faiss_index.ntotal == 3
+
+    # FAISS indexes that don't match the Annoy index are ignored
+    faiss_index.add(vectors)
+    faiss.write_index(faiss_index, str(index_dir / settings.FAISS_INDEX_FILE_NAME))
+    assert api.ANNIndex.load(index_dir).faiss_index is None
+
+
+def test_ann_without_distances(client):
+    response = client.simulate_get(
+        "/api/v1/ann/1", params={"index": "test", "count": 3, "distances": "false"}
+    )
+    results = response.json["results"]
+    assert len(results) == 3
+    assert results[0] == {"logo_id": 1}
+
+    response = client.simulate_get(
+        "/api/v1/ann/1", params={"index": "test", "count": 3}
+    )
+    assert [r["logo_id"] for r in response.json["results"]] == [
+        r["logo_id"] for r in results
+    ]
+    assert "distance" in response.json["results"][0]
+
+
+def test_ann_batch_annoy_without_distances(client, ann_index):
+    ann_index.faiss_index = None
+    response = client.simulate_get(
+        "/api/v1/ann/batch",
+        params={"index": "test", "count": 2, "logo_ids": "4,1", "distances": "false"},
+    )
+    results = response.json["results"]
+    assert list(results.keys()) == ["4", "1"]
+    assert all("distance" not in r for r in results["4"] + results["1"])
+
+
+@pytest.mark.parametrize("distances", ["false", 0, None])
+def test_ann_from_embedding_invalid_distances(client, distances):
+    response = client.simulate_post(
+        "/api/v1/ann/from_embedding",
+        params={"index": "test"},
+        json={"embedding": [0.0] * EMBEDDING_SIZE, "distances": distances},
+    )
+    assert response.status_code == 400
+    assert response.json["title"] == "invalid distances"
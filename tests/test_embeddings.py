@@ -0,0 +1,174 @@
+import threading
+
+import numpy as np
+import pytest
+import torch
+
+import embeddings
+import settings
+from embeddings import EmbeddingBatcher, EmbeddingStore
+
+EMBEDDING_SIZE = 8
+
+
+@pytest.fixture
+def hdf5_path(tmp_path, monkeypatch):
+    monkeypatch.setattr(settings, "DEFAULT_HDF5_COUNT", 2000)
+    return tmp_path / "embeddings.hdf5"
+
+
+def generate_embeddings(count: int, seed: int = 0) -> np.ndarray:
+    rng = np.random.default_rng(seed)
+    return rng.random((count, EMBEDDING_SIZE), dtype=np.float32)
+
+
+def test_save_embeddings(hdf5_path):
+    store = EmbeddingStore(hdf5_path)
+    all_embeddings = generate_embeddings(1500)
+    offset = 0
+
+    # Cross the initial in-memory capacity, so that in-memory arrays grow
+    for count in (1, 5, 1100, 394):
+        next_offset = offset + count
+        store.save_embeddings(
+            all_embeddings[offset:next_offset], np.arange(offset + 1, next_offset + 1)
+        )
+        offset = next_offset
+
+        reloaded_store = EmbeddingStore(hdf5_path)
+        assert len(store) == len(reloaded_store) == offset
+        assert store.offset == reloaded_store.offset == offset
+        assert store.logo_id_to_idx == reloaded_store.logo_id_to_idx
+        np.testing.assert_array_equal(
+            store._embeddings[:offset], reloaded_store._embeddings[:offset]
+        )
+        np.testing.assert_array_equal(
+            store._external_ids[:offset], reloaded_store._external_ids[:offset]
+        )
+
+    np.testing.assert_array_equal(store._embeddings[:offset], all_embeddings)
+    disk_store = EmbeddingStore(hdf5_path, in_memory=False)
+    np.testing.assert_array_equal(disk_store.get_embedding(1234), all_embeddings[1233])
+
+
+def test_get_embeddings(hdf5_path):
+    store = EmbeddingStore(hdf5_path)
+    assert store.get_embeddings([1, 2]) == ([], None)
+
+    all_embeddings = generate_embeddings(5)
+    store.save_embeddings(all_embeddings, np.arange(1, 6))
+    logo_ids, found_embeddings = store.get_embeddings([4, 10, 1])
+
+    assert logo_ids == [4, 1]
+    np.testing.assert_array_equal(found_embeddings, all_embeddings[[3, 0]])
+
+    with pytest.raises(ValueError):
+        EmbeddingStore(hdf5_path, in_memory=False).get_embeddings([1])
+
+
+def test_get_exact_nearest_neighbors(hdf5_path):
+    store = EmbeddingStore(hdf5_path)
+    assert store.get_exact_nearest_neighbors(np.zeros(EMBEDDING_SIZE), 3) == ([], [])
+
+    first_embeddings = generate_embeddings(5, seed=0)
+    store.save_embeddings(first_embeddings, np.arange(1, 6))
+    # Saving logo 3 again (twice) leaves stale rows behind
+    second_embeddings = generate_embeddings(3, seed=1)
+    store.save_embeddings(second_embeddings, np.array([3, 6, 3]))
+
+    for query_store in (store, EmbeddingStore(hdf5_path)):
+        logo_ids, distances = query_store.get_exact_nearest_neighbors(
+            second_embeddings[2], 10
+        )
+        assert sorted(logo_ids) == [1, 2, 3, 4, 5, 6]
+        assert logo_ids[0] == 3
+        assert distances[0] == pytest.approx(0, abs=1e-3)
+        assert distances == sorted(distances)
+
+        logo_ids, _ = query_store.get_exact_nearest_neighbors(first_embeddings[2], 3)
+        assert len(logo_ids) == 3
+        assert len(set(logo_ids)) == 3
+
+
+@pytest.mark.parametrize("batch_size", [1, 2, 3, 4, 1024])
+def test_iter_embeddings(hdf5_path, batch_size):
+    store = EmbeddingStore(hdf5_path)
+    first_embeddings = generate_embeddings(5, seed=0)
+    store.save_embeddings(first_embeddings, np.arange(1, 6))
+    # Saving logo 3 again leaves a gap at its previous index
+    second_embeddings = generate_embeddings(2, seed=1)
+    store.save_embeddings(second_embeddings, np.array([3, 6]))
+
+    expected = [
+        (1, first_embeddings[0]),
+        (2, first_embeddings[1]),
+        (4, first_embeddings[3]),
+        (5, first_embeddings[4]),
+        (3, second_embeddings[0]),
+        (6, second_embeddings[1]),
+    ]
+
+    for iter_store in (store, EmbeddingStore(hdf5_path, in_memory=False)):
+        results = list(iter_store.iter_embeddings(batch_size=batch_size))
+        assert [logo_id for logo_id, _ in results] == [
+            logo_id for logo_id, _ in expected
+        ]
+
+        for (_, embedding), (_, expected_embedding) in zip(results, expected):
+            np.testing.assert_array_equal(embedding, expected_embedding)
+
+
+def test_iter_embeddings_missing_file(hdf5_path):
+    assert list(EmbeddingStore(hdf5_path).iter_embeddings()) == []
+
+
+def fake_generate_embeddings(model, images: torch.Tensor, device: torch.device):
+    return images.reshape(len(images), -1).numpy()
+
+
+def test_embedding_batcher(monkeypatch):
+    batch_sizes = []
+
+    def generate(model, images: torch.Tensor, device: torch.device):
+        batch_sizes.append(len(images))
+        return fake_generate_embeddings(model, images, device)
+
+    # All submitted batches fit in the window and are run in a single pass
+    monkeypatch.setattr(settings, "EMBEDDING_BATCH_WINDOW", 0.5)
+    monkeypatch.setattr(embeddings.ModelStore, "get", lambda *args: "model")
+    monkeypatch.setattr(embeddings, "generate_embeddings", generate)
+    batcher = EmbeddingBatcher(settings.DEFAULT_MODEL, torch.device("cpu"))
+    images = [torch.full((count, 3, 2, 2), float(count)) for count in (1, 2, 3)]
+    futures = [batcher.submit(x) for x in images]
+
+    for x, future in zip(images, futures):
+        np.testing.assert_array_equal(
+            future.result(timeout=5), x.reshape(len(x), -1).numpy()
+        )
+
+    assert batch_sizes == [6]
+
+
+def test_embedding_batcher_model_loading_error(monkeypatch):
+    loaded = threading.Event()
+
+    def get_model(*args):
+        if not loaded.is_set():
+            loaded.set()
+            raise RuntimeError("model loading failed")
+
+        return "model"
+
+    monkeypatch.setattr(settings, "EMBEDDING_BATCH_WINDOW", 0)
+    monkeypatch.setattr(embeddings.ModelStore, "get", get_model)
+    monkeypatch.setattr(embeddings, "generate_embeddings", fake_generate_embeddings)
+    batcher = EmbeddingBatcher(settings.DEFAULT_MODEL, torch.device("cpu"))
+    images = torch.ones((1, 3, 2, 2))
+
+    with pytest.raises(RuntimeError):
+        batcher.submit(images).result(timeout=5)
+
+    # Loading the model is retried on the next batch
+    np.testing.assert_array_equal(
+        batcher.submit(images).result(timeout=5), np.ones((1, 12), dtype=np.float32)
+    )
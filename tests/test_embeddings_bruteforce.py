@@ -0,0 +1,40 @@
+import numpy as np
+
+from embeddings_bruteforce import topk_l2
+
+
+def generate(num_embeddings: int, embedding_size: int = 16):
+    rng = np.random.default_rng(42)
+    embeddings = rng.random((num_embeddings, embedding_size), dtype=np.float32)
+    query = rng.random(embedding_size, dtype=np.float32)
+    return embeddings, query
+
+
+def test_topk_l2():
+    embeddings, query = generate(100)
+    indexes, distances = topk_l2(embeddings, query, 10)
+
+    expected_distances = np.linalg.norm(embeddings - query, axis=1)
+    expected_indexes = np.argsort(expected_distances)[:10]
+    np.testing.assert_array_equal(indexes, expected_indexes)
+    np.testing.assert_allclose(
+        distances, expected_distances[expected_indexes], rtol=1e-5
+    )
+    assert np.all(np.diff(distances) >= 0)
+
+
+def test_topk_l2_k_greater_than_count():
+    embeddings, query = generate(5)
+    indexes, distances = topk_l2(embeddings, query, 10)
+
+    assert sorted(indexes.tolist()) == list(range(5))
+    assert len(distances) == 5
+    assert np.all(np.diff(distances) >= 0)
+
+
+def test_topk_l2_k_zero():
+    embeddings, query = generate(5)
+    indexes, distances = topk_l2(embeddings, query, 0)
+
+    assert len(indexes) == 0
+    assert len(distances) == 0